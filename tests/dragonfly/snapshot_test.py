@@ -1,37 +1,71 @@
 import time
 import pytest
 import os
-import glob
+import sys
+import fnmatch
+import re
 import asyncio
 from redis import asyncio as aioredis
 from pathlib import Path
 import boto3
+import botocore.config
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
+if sys.platform == "linux":
+    from asyncinotify import Inotify, Mask
+
 from . import dfly_args
 from .utility import DflySeeder, wait_available_async
 
 BASIC_ARGS = {"dir": "{DRAGONFLY_TMP}/"}
 
 SEEDER_ARGS = dict(keys=12_000, dbcount=5, multi_transaction_probability=0)
+# For tests that only need some data to be saved, e.g. shutdown handling
+LIGHT_SEEDER_ARGS = dict(keys=200, dbcount=1, multi_transaction_probability=0)
+
+# INFO lines are terminated with \r\n
+_MEM_RE = re.compile(rb"^(object_used_memory|type_used_memory_[^:]+):(\d+)\r?$", re.M)
+_LOADING_RE = re.compile(rb"^loading:(\d)\r?$", re.M)
 
 
 class SnapshotTestBase:
     def setup(self, tmp_dir: Path):
         self.tmp_dir = tmp_dir
+        self._tmp_prefix = str(tmp_dir.absolute()) + "/"
+
+    def list_files(self, pattern):
+        with os.scandir(self._tmp_prefix) as it:
+            names = [entry.name for entry in it]
+        return [self._tmp_prefix + n for n in names if fnmatch.fnmatchcase(n, pattern)]
 
     def get_main_file(self, pattern):
         def is_main(f):
             return "summary" in f if pattern.endswith("dfs") else True
 
-        files = glob.glob(str(self.tmp_dir.absolute()) + "/" + pattern)
+        files = self.list_files(pattern)
         possible_mains = list(filter(is_main, files))
         assert len(possible_mains) == 1, possible_mains
         return possible_mains[0]
 
+    async def _await_file(self, pattern):
+        with Inotify() as inotify:
+            inotify.add_watch(self.tmp_dir, Mask.CREATE | Mask.MOVED_TO | Mask.CLOSE_WRITE)
+            # The file might have been created before the watch was added
+            if self.list_files(pattern):
+                return
+            async for event in inotify:
+                if event.name is not None and fnmatch.fnmatchcase(str(event.name), pattern):
+                    return
+
     async def wait_for_save(self, pattern):
+        if sys.platform == "linux":
+            await self._await_file(pattern)
+            return
+
         while True:
-            files = glob.glob(str(self.tmp_dir.absolute()) + "/" + pattern)
+            files = self.list_files(pattern)
             if not len(files) == 0:
                 break
             await asyncio.sleep(1)
@@ -71,11 +105,9 @@ class TestRdbSnapshotExactFilename(SnapshotTestBase):
 
     @pytest.mark.asyncio
     @pytest.mark.slow
-    async def test_snapshot(self, df_seeder_factory, async_client, df_server):
-        seeder = df_seeder_factory.create(port=df_server.port, **SEEDER_ARGS)
-        await seeder.run(target_deviation=0.1)
-
-        start_capture = await seeder.capture()
+    async def test_snapshot(self, async_client, df_server):
+        # Only the filename handling is tested here, so a canary key is enough to check the load
+        await async_client.set("canary", "v")
 
         # save + flush + load
         await async_client.execute_command("SAVE RDB")
@@ -83,7 +115,7 @@ class TestRdbSnapshotExactFilename(SnapshotTestBase):
         main_file = super().get_main_file("test-rdbexact.rdb")
         await async_client.execute_command("DEBUG LOAD " + main_file)
 
-        assert await seeder.compare(start_capture, port=df_server.port)
+        assert await async_client.get("canary") == "v"
 
 
 @dfly_args({**BASIC_ARGS, "dbfilename": "test-dfs"})
@@ -92,7 +124,7 @@ class TestDflySnapshot(SnapshotTestBase):
 
     @pytest.fixture(autouse=True)
     def setup(self, tmp_dir: Path):
-        self.tmp_dir = tmp_dir
+        super().setup(tmp_dir)
 
     @pytest.mark.asyncio
     @pytest.mark.slow
@@ -121,7 +153,7 @@ class TestDflyAutoLoadSnapshot(SnapshotTestBase):
 
     @pytest.fixture(autouse=True)
     def setup(self, tmp_dir: Path):
-        self.tmp_dir = tmp_dir
+        super().setup(tmp_dir)
 
     cases = [
         ("rdb", "test-autoload1-{{timestamp}}"),
@@ -135,7 +167,8 @@ class TestDflyAutoLoadSnapshot(SnapshotTestBase):
     @pytest.mark.asyncio
     @pytest.mark.parametrize("save_type, dbfilename", cases)
     async def test_snapshot(self, df_local_factory, save_type, dbfilename):
-        df_args = {"dbfilename": dbfilename, **BASIC_ARGS, "port": 1111}
+        # No fixed port: each instance picks a free one, so cases can't collide on a port
+        df_args = {"dbfilename": dbfilename, **BASIC_ARGS}
         if save_type == "rdb":
             df_args["nodf_snapshot_format"] = None
         with df_local_factory.create(**df_args) as df_server:
@@ -209,16 +242,15 @@ class TestSnapshotShutdownWithRenameSave(SnapshotTestBase):
     @pytest.mark.asyncio
     async def test_snapshot(self, df_server, df_seeder_factory):
         """Checks that on shutdown we save snapshot"""
-        seeder = df_seeder_factory.create(port=df_server.port)
+        seeder = df_seeder_factory.create(port=df_server.port, **LIGHT_SEEDER_ARGS)
         await seeder.run(target_deviation=0.1)
 
         start_capture = await seeder.capture()
-        a_client = aioredis.Redis(port=df_server.port)
 
         df_server.stop()
         df_server.start()
 
-        a_client = aioredis.Redis(port=df_server.port)
+        a_client = aioredis.Redis(port=df_server.port, single_connection_client=True)
         await wait_available_async(a_client)
         await a_client.connection_pool.disconnect()
 
@@ -236,9 +268,8 @@ class TestOnlyOneSaveAtATime(SnapshotTestBase):
     @pytest.mark.asyncio
     @pytest.mark.slow
     async def test_snapshot(self, async_client, df_server):
-        await async_client.execute_command(
-            "debug", "populate", "1000000", "askldjh", "1000", "RAND"
-        )
+        # Just enough data for SAVE to take long enough for the two commands to overlap
+        await async_client.execute_command("debug", "populate", "100000", "askldjh", "100", "RAND")
 
         async def save():
             try:
@@ -247,13 +278,9 @@ class TestOnlyOneSaveAtATime(SnapshotTestBase):
             except Exception as e:
                 return False
 
-        save_commnands = [asyncio.create_task(save()) for _ in range(2)]
+        results = await asyncio.gather(save(), save())
 
-        num_successes = 0
-        for result in asyncio.as_completed(save_commnands):
-            num_successes += await result
-
-        assert num_successes == 1, "Only one SAVE must be successful"
+        assert sum(results) == 1, "Only one SAVE must be successful"
 
 
 @dfly_args({**BASIC_ARGS})
@@ -281,28 +308,30 @@ class TestDflySnapshotOnShutdown(SnapshotTestBase):
 
     @pytest.fixture(autouse=True)
     def setup(self, tmp_dir: Path):
-        self.tmp_dir = tmp_dir
+        super().setup(tmp_dir)
 
     async def _get_info_memory_fields(self, client):
         res = await client.execute_command("INFO MEMORY")
-        fields = {}
-        for line in res.decode("ascii").splitlines():
-            if line.startswith("#"):
-                continue
-            k, v = line.split(":")
-            if k == "object_used_memory" or k.startswith("type_used_memory_"):
-                fields.update({k: int(v)})
-        return fields
+        return {m.group(1).decode(): int(m.group(2)) for m in _MEM_RE.finditer(res)}
 
     async def _delete_all_keys(self, client):
-        # Delete all keys from all DBs
+        # Delete all keys from all DBs. Keys are deleted one by one rather than with FLUSHDB,
+        # because the point is to check that per-key deletion brings the memory counters to 0.
+        keys_per_db = []
         for i in range(0, SEEDER_ARGS["dbcount"]):
             await client.select(i)
-            while True:
-                keys = await client.keys("*")
-                if len(keys) == 0:
-                    break
-                await client.delete(*keys)
+            keys_per_db.append([key async for key in client.scan_iter(count=1000)])
+        await client.select(0)
+
+        # Send all deletes in one round trip. The pipeline may use a different connection than
+        # the client, so it also ends with SELECT 0 before going back to the pool.
+        async with client.pipeline(transaction=False) as pipe:
+            for i, keys in enumerate(keys_per_db):
+                pipe.select(i)
+                for start in range(0, len(keys), 1000):
+                    pipe.delete(*keys[start : start + 1000])
+            pipe.select(0)
+            await pipe.execute()
 
     @pytest.mark.asyncio
     async def test_memory_counters(self, df_seeder_factory, df_server):
@@ -333,15 +362,15 @@ class TestDflySnapshotOnShutdown(SnapshotTestBase):
         await seeder.run(target_deviation=0.1)
 
         start_capture = await seeder.capture()
-        a_client = aioredis.Redis(port=df_server.port)
+        a_client = aioredis.Redis(port=df_server.port, single_connection_client=True)
         memory_before = await self._get_info_memory_fields(a_client)
 
         df_server.stop()
         df_server.start()
 
-        a_client = aioredis.Redis(port=df_server.port)
+        # Reuse the client, dropping its connection to the stopped instance
+        await a_client.connection_pool.disconnect(inuse_connections=True)
         await wait_available_async(a_client)
-        await a_client.connection_pool.disconnect()
 
         assert await seeder.compare(start_capture, port=df_server.port)
         memory_after = await self._get_info_memory_fields(a_client)
@@ -355,6 +384,8 @@ class TestDflySnapshotOnShutdown(SnapshotTestBase):
         memory_empty = await self._get_info_memory_fields(a_client)
         assert memory_empty == {"object_used_memory": 0}
 
+        await a_client.connection_pool.disconnect()
+
 
 @dfly_args({**BASIC_ARGS, "dbfilename": "test-info-persistence"})
 class TestDflyInfoPersistenceLoadingField(SnapshotTestBase):
@@ -362,13 +393,10 @@ class TestDflyInfoPersistenceLoadingField(SnapshotTestBase):
 
     @pytest.fixture(autouse=True)
     def setup(self, tmp_dir: Path):
-        self.tmp_dir = tmp_dir
+        super().setup(tmp_dir)
 
     def extract_is_loading_field(self, res):
-        matcher = b"loading:"
-        start = res.find(matcher)
-        pos = start + len(matcher)
-        return chr(res[pos])
+        return _LOADING_RE.search(res).group(1).decode()
 
     @pytest.mark.asyncio
     async def test_snapshot(self, df_seeder_factory, df_server):
@@ -379,7 +407,7 @@ class TestDflyInfoPersistenceLoadingField(SnapshotTestBase):
         # Wait for snapshot to finish loading and try INFO PERSISTENCE
         await wait_available_async(a_client)
         res = await a_client.execute_command("INFO PERSISTENCE")
-        assert "0" == self.extract_is_loading_field(res)
+        assert self.extract_is_loading_field(res) == "0"
 
         await a_client.connection_pool.disconnect()
 
@@ -424,15 +452,27 @@ class TestS3Snapshot:
             )
 
     def _delete_objects(self, bucket, prefix):
-        client = boto3.client("s3")
-        resp = client.list_objects_v2(
-            Bucket=bucket,
-            Prefix=prefix,
-        )
-        keys = []
-        for obj in resp["Contents"]:
-            keys.append({"Key": obj["Key"]})
-        client.delete_objects(
-            Bucket=bucket,
-            Delete={"Objects": keys},
+        client = boto3.client("s3", config=botocore.config.Config(max_pool_connections=16))
+        paginator = client.get_paginator("list_objects_v2")
+        keys = (
+            {"Key": obj["Key"]}
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix)
+            for obj in page.get("Contents", [])
         )
+
+        # delete_objects accepts at most 1000 keys per request
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = []
+            while batch := list(itertools.islice(keys, 1000)):
+                futures.append(
+                    executor.submit(
+                        client.delete_objects,
+                        Bucket=bucket,
+                        Delete={"Objects": batch, "Quiet": True},
+                    )
+                )
+            for future in futures:
+                # delete_objects succeeds as a whole even if some keys fail, so check Errors.
+                # Only log them: this runs during cleanup and must not hide the test's own failure.
+                for error in future.result().get("Errors", []):
+                    logging.error(f"Failed to delete {error['Key']} from S3: {error['Message']}")